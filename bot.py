@@ -3,7 +3,7 @@ Telegram bot for vacancy collection with Ozon Bank card referral
 ---------------------------------------------------------------
 Setup:
 1) Install dependencies:
-   pip install aiogram==2.25.1 python-dotenv
+   pip install aiogram==2.25.1 python-dotenv orjson
    (optional for Google Sheets: gspread oauth2client)
 
 2) Create a .env file in the same folder with these variables:
@@ -16,10 +16,14 @@ Setup:
    python bot.py
 """
 
+import asyncio
+import atexit
+import concurrent.futures
 import logging
 import os
-import csv
-from datetime import datetime
+import re
+import signal
+import time
 
 # --- Загружаем .env только при локальном запуске ---
 from dotenv import load_dotenv
@@ -29,23 +33,36 @@ if os.path.exists('.env'):
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 REF_LINK = os.getenv('REF_LINK', 'https://example.com')
 MANAGER_USERNAME = os.getenv('MANAGER_USERNAME', '@manager')
+MANAGER_URL = f'https://t.me/{MANAGER_USERNAME.lstrip("@")}'
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')  # optional
 
 if not BOT_TOKEN:
     raise RuntimeError('❌ BOT_TOKEN не найден! Проверь .env или переменные Railway')
 
+import orjson
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.filters import Text
+from aiogram.utils import json as aiogram_json
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+# aiogram сериализует аргументы запросов и разбирает ответы API через
+# aiogram.utils.json.dumps/loads, вызывая их при каждом запросе — подменяем на orjson.
+aiogram_json.dumps = lambda data: orjson.dumps(data).decode()
+aiogram_json.loads = orjson.loads
 
-CSV_FILE = 'submissions.csv'
+bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher(bot)
+
+SUBMISSIONS_FILE = 'submissions.jsonl'
+PHONE_RE = re.compile(r'\+[0-9]{6,15}')
+# Пробелы, дефисы и скобки в номере вроде +7 (999) 123-45-67 просто отбрасываем.
+_PHONE_SEPARATORS = str.maketrans('', '', ' -()')
+FIELDS = (
+    'timestamp', 'tg_id', 'username', 'full_name', 'phone', 'has_ozon_card', 'card_applied', 'ref_link_used'
+)
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 2.0
 
 # --- Тексты ---
 WELCOME_TEXT = (
@@ -58,6 +75,7 @@ WELCOME_TEXT = (
 
 ASK_NAME = "Напишите, пожалуйста, *ФИО* полностью (пример: Иванов Иван Иванович):"
 ASK_PHONE = "Отправьте ваш номер телефона (можно нажать кнопку — отправить контакт):"
+ASK_PHONE_MANUAL = "Отправьте ваш номер в формате +7XXXXXXXXXX:"
 ASK_OZON = "У вас уже есть карта Ozon Bank? Это нужно для выплат:"
 
 OZON_PROMO = (
@@ -72,144 +90,270 @@ APPLICATION_SUBMITTED = (
     "Если хотите — напишите менеджеру прямо сейчас по кнопке ниже."
 )
 
-# --- Состояния ---
-class ApplyStates(StatesGroup):
-    waiting_for_name = State()
-    waiting_for_phone = State()
-    waiting_for_ozon_status = State()
-    waiting_for_card_confirmation = State()
+FALLBACK_TEXT = "Чтобы подать заявку, нажмите кнопку *Подать заявку*."
+EXPIRED_TEXT = "Заявка устарела. Чтобы начать заново, нажмите кнопку *Подать заявку*."
+
+def _render_markdown(text: str):
+    """Раскрывает *жирный* из Markdown в (текст, entities JSON), чтобы Telegram не парсил текст заново.
+
+    Другая разметка не поддерживается: на _, ` и [ бросаем ValueError, а не отправляем их как есть.
+    """
+    for char in '_`[':
+        if char in text:
+            raise ValueError(f'Неподдерживаемая разметка {char!r} в тексте: {text!r}')
+    parts = text.split('*')
+    if not len(parts) % 2:
+        raise ValueError(f'Непарная * в тексте: {text!r}')
+    entities = []
+    offset = 0
+    for i, part in enumerate(parts):
+        length = len(part.encode('utf-16-le')) // 2  # Telegram считает смещения в UTF-16
+        if i % 2 and length:
+            entities.append({'type': 'bold', 'offset': offset, 'length': length})
+        offset += length
+    return ''.join(parts), orjson.dumps(entities).decode()
+
+WELCOME = _render_markdown(WELCOME_TEXT)
+PROMO = _render_markdown(OZON_PROMO)
+SUBMITTED = _render_markdown(APPLICATION_SUBMITTED)
+FALLBACK = _render_markdown(FALLBACK_TEXT)
+EXPIRED = _render_markdown(EXPIRED_TEXT)
+
+# --- Сессии ---
+# Пока заявка заполняется, по id пользователя лежит кортеж (ФИО, телефон, шаг).
+# Брошенные на полпути сессии удаляются через SESSION_TTL секунд без активности.
+STEP_NAME, STEP_PHONE, STEP_OZON, STEP_CARD = range(4)
+SESSION_TTL = 30 * 60
+SESSION_SWEEP_INTERVAL = 60
+SESSIONS: dict = {}
+_last_touch: dict = {}
+sweeper_task = None  # создаётся в on_startup
+
+def _step(user_id: int):
+    session = SESSIONS.get(user_id)
+    return session[2] if session else None
+
+def _touch_session(user_id: int):
+    _last_touch[user_id] = time.monotonic()
+
+def _save_session(user_id: int, name: str, phone: str, step: int):
+    SESSIONS[user_id] = (name, phone, step)
+    _touch_session(user_id)
+
+def _drop_session(user_id: int) -> tuple:
+    _last_touch.pop(user_id, None)
+    return SESSIONS.pop(user_id)
+
+async def _session_sweeper():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        deadline = time.monotonic() - SESSION_TTL
+        for user_id, touched in list(_last_touch.items()):
+            if touched < deadline:
+                _drop_session(user_id)
 
 # --- Сохранение ---
-def save_submission(data: dict):
-    fieldnames = [
-        'timestamp', 'tg_id', 'username', 'full_name', 'phone', 'has_ozon_card', 'card_applied', 'ref_link_used'
-    ]
-    exists = os.path.exists(CSV_FILE)
-    with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        if not exists:
-            writer.writeheader()
-        writer.writerow(data)
-
-async def notify_admin(text: str):
-    if ADMIN_CHAT_ID:
+# Заявки копятся в очереди и пишутся на диск пачками из фоновой задачи,
+# чтобы хэндлеры не блокировали event loop на файловом I/O.
+submission_queue = None  # создаются в on_startup
+writer_task = None
+
+# Заявки пишутся в JSON Lines: по объекту на строку, заголовок не нужен
+# (читается через pd.read_json('submissions.jsonl', lines=True)).
+# Файл открыт на всё время работы процесса с O_APPEND, и каждая пачка уходит одним
+# os.write без дозаписи остатка, поэтому чужие строки не попадают внутрь пачки.
+_submissions_fd = os.open(SUBMISSIONS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+atexit.register(os.close, _submissions_fd)
+# Единственный поток-писатель владеет файлом, поэтому блокировка не нужна.
+_writer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='submissions')
+
+def _now_iso() -> str:
+    t = time.gmtime()
+    return f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}'
+
+# Заявка — кортеж в порядке FIELDS, без промежуточного dict.
+async def save_submission(row: tuple):
+    await submission_queue.put(row)
+
+def _flush_batch(batch: list):
+    data = b''.join(orjson.dumps(dict(zip(FIELDS, row))) + b'\n' for row in batch)
+    written = os.write(_submissions_fd, data)
+    if written < len(data):
+        # Неполная запись (например, диск почти заполнен): закрываем оборванную строку,
+        # чтобы следующая пачка начиналась с новой строки, и сообщаем об ошибке.
+        os.write(_submissions_fd, b'\n')
+        raise OSError(f'записано {written} из {len(data)} байт в {SUBMISSIONS_FILE}')
+
+async def _submission_writer():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
         try:
-            await bot.send_message(ADMIN_CHAT_ID, text, parse_mode='Markdown')
+            item = await asyncio.wait_for(submission_queue.get(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            continue
+        # Забираем то, что уже лежит в очереди (не больше BATCH_SIZE), и сразу пишем:
+        # пользователь уже получил «Ваша информация сохранена», ждать нельзя.
+        # None — сигнал остановки.
+        batch = []
+        while True:
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+            if len(batch) >= BATCH_SIZE:
+                break
+            try:
+                item = submission_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        if batch:
+            try:
+                await loop.run_in_executor(_writer_executor, _flush_batch, batch)
+            except Exception as e:
+                logging.exception('Не удалось сохранить заявки: %s', e)
+
+# ADMIN_CHAT_ID не меняется во время работы, поэтому выбираем реализацию один раз при импорте.
+if ADMIN_CHAT_ID:
+    async def notify_admin(text_template: str, row: tuple):
+        # dict для текста строится только здесь, когда уведомление действительно отправляется.
+        try:
+            await bot.send_message(ADMIN_CHAT_ID, text_template % (dict(zip(FIELDS, row)),), parse_mode='Markdown')
         except Exception as e:
             logging.exception('Не удалось отправить уведомление админу: %s', e)
+else:
+    async def notify_admin(text_template: str, row: tuple):
+        pass
 
 # --- Клавиатуры ---
-def main_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton('Подать заявку'))
-    return kb
-
-def contact_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton('Отправить контакт', request_contact=True))
-    kb.add(types.KeyboardButton('Ввести номер вручную'))
-    return kb
-
-def ozon_choice_keyboard():
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton('Да, есть', callback_data='ozon_yes'))
-    kb.add(types.InlineKeyboardButton('Нет, оформлю', callback_data='ozon_no'))
-    return kb
-
-def ozon_ref_keyboard():
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton('Оформить карту Ozon (бесплатно)', url=REF_LINK))
-    kb.add(types.InlineKeyboardButton('Я оформил(а) карту', callback_data='card_done'))
-    return kb
-
-def manager_keyboard():
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton('Написать менеджеру', url=f'https://t.me/{MANAGER_USERNAME.lstrip("@")}'))
-    return kb
+# Разметка не меняется после создания, поэтому собираем её один раз при импорте.
+MAIN_KB = types.ReplyKeyboardMarkup(resize_keyboard=True)
+MAIN_KB.add(types.KeyboardButton('Подать заявку'))
+
+CONTACT_KB = types.ReplyKeyboardMarkup(resize_keyboard=True)
+CONTACT_KB.add(types.KeyboardButton('Отправить контакт', request_contact=True))
+CONTACT_KB.add(types.KeyboardButton('Ввести номер вручную'))
+
+OZON_CHOICE_KB = types.InlineKeyboardMarkup()
+OZON_CHOICE_KB.add(types.InlineKeyboardButton('Да, есть', callback_data='ozon_yes'))
+OZON_CHOICE_KB.add(types.InlineKeyboardButton('Нет, оформлю', callback_data='ozon_no'))
+
+OZON_REF_KB = types.InlineKeyboardMarkup()
+OZON_REF_KB.add(types.InlineKeyboardButton('Оформить карту Ozon (бесплатно)', url=REF_LINK))
+OZON_REF_KB.add(types.InlineKeyboardButton('Я оформил(а) карту', callback_data='card_done'))
+
+MANAGER_KB = types.InlineKeyboardMarkup()
+MANAGER_KB.add(types.InlineKeyboardButton('Написать менеджеру', url=MANAGER_URL))
+
+# Строку в reply_markup aiogram отправляет как есть, так что сериализуем разметку
+# в JSON один раз, а не через json.dumps на каждое сообщение.
+MAIN_KB_JSON = MAIN_KB.as_json()
+CONTACT_KB_JSON = CONTACT_KB.as_json()
+OZON_CHOICE_KB_JSON = OZON_CHOICE_KB.as_json()
+OZON_REF_KB_JSON = OZON_REF_KB.as_json()
+MANAGER_KB_JSON = MANAGER_KB.as_json()
+REMOVE_KB_JSON = types.ReplyKeyboardRemove().as_json()
 
 # --- Хэндлеры ---
 @dp.message_handler(commands=['start', 'help'])
 async def cmd_start(message: types.Message):
-    await message.answer(WELCOME_TEXT, parse_mode='Markdown', reply_markup=main_keyboard())
+    await message.answer(WELCOME[0], entities=WELCOME[1], reply_markup=MAIN_KB_JSON)
 
-@dp.message_handler(lambda m: m.text == 'Подать заявку')
+@dp.message_handler(Text(equals='Подать заявку'))
 async def start_application(message: types.Message):
-    await ApplyStates.waiting_for_name.set()
-    await message.answer(ASK_NAME, reply_markup=types.ReplyKeyboardRemove())
-
-@dp.message_handler(state=ApplyStates.waiting_for_name, content_types=types.ContentTypes.TEXT)
-async def process_name(message: types.Message, state: FSMContext):
-    name = message.text.strip()
-    await state.update_data(full_name=name)
-    await ApplyStates.waiting_for_phone.set()
-    await message.answer(ASK_PHONE, reply_markup=contact_keyboard())
-
-@dp.message_handler(lambda m: m.text == 'Ввести номер вручную', state=ApplyStates.waiting_for_phone)
-async def ask_manual_phone(message: types.Message):
-    await message.answer('Отправьте ваш номер в формате +7XXXXXXXXXX:')
-
-@dp.message_handler(content_types=types.ContentTypes.CONTACT, state=ApplyStates.waiting_for_phone)
-async def process_contact(message: types.Message, state: FSMContext):
-    phone = message.contact.phone_number
-    await state.update_data(phone=phone)
-    await ApplyStates.waiting_for_ozon_status.set()
-    await message.answer(ASK_OZON, reply_markup=ozon_choice_keyboard())
-
-@dp.message_handler(lambda m: m.text and m.text.startswith('+'), state=ApplyStates.waiting_for_phone)
-async def process_manual_phone(message: types.Message, state: FSMContext):
-    phone = message.text.strip()
-    await state.update_data(phone=phone)
-    await ApplyStates.waiting_for_ozon_status.set()
-    await message.answer(ASK_OZON, reply_markup=ozon_choice_keyboard())
-
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('ozon_'), state=ApplyStates.waiting_for_ozon_status)
-async def process_ozon_choice(callback: types.CallbackQuery, state: FSMContext):
-    await callback.answer()
-    choice = callback.data.split('_', 1)[1]
-    if choice == 'yes':
-        data = await state.get_data()
-        submission = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'tg_id': callback.from_user.id,
-            'username': callback.from_user.username or '',
-            'full_name': data.get('full_name', ''),
-            'phone': data.get('phone', ''),
-            'has_ozon_card': 'yes',
-            'card_applied': 'n/a',
-            'ref_link_used': ''
-        }
-        save_submission(submission)
-        await notify_admin(f"Новая заявка: {submission}")
-        await callback.message.answer(APPLICATION_SUBMITTED, parse_mode='Markdown', reply_markup=manager_keyboard())
-        await state.finish()
+    _save_session(message.from_user.id, '', '', STEP_NAME)
+    await message.answer(ASK_NAME, reply_markup=REMOVE_KB_JSON)
+
+@dp.message_handler(lambda m: _step(m.from_user.id) == STEP_PHONE, content_types=types.ContentTypes.CONTACT)
+async def process_contact(message: types.Message):
+    name, _, _ = SESSIONS[message.from_user.id]
+    _save_session(message.from_user.id, name, message.contact.phone_number, STEP_OZON)
+    await message.answer(ASK_OZON, reply_markup=OZON_CHOICE_KB_JSON)
+
+@dp.callback_query_handler(lambda c: c.data in ('ozon_yes', 'ozon_no') and _step(c.from_user.id) == STEP_OZON)
+async def process_ozon_choice(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    name, phone, _ = SESSIONS[user_id]
+    if callback.data == 'ozon_yes':
+        _drop_session(user_id)
+        row = (_now_iso(), user_id, callback.from_user.username or '', name, phone, 'yes', 'n/a', '')
+        await save_submission(row)
+        # Ответ на callback и сообщения уходят параллельно, а не тремя последовательными запросами.
+        await asyncio.gather(
+            callback.answer(),
+            notify_admin("Новая заявка: %s", row),
+            callback.message.answer(SUBMITTED[0], entities=SUBMITTED[1], reply_markup=MANAGER_KB_JSON),
+        )
     else:
-        await ApplyStates.waiting_for_card_confirmation.set()
-        await callback.message.answer(OZON_PROMO, parse_mode='Markdown', reply_markup=ozon_ref_keyboard())
-
-@dp.callback_query_handler(lambda c: c.data == 'card_done', state=ApplyStates.waiting_for_card_confirmation)
-async def card_done(callback: types.CallbackQuery, state: FSMContext):
-    await callback.answer('Отлично — пометили, что вы оформили карту.')
-    data = await state.get_data()
-    submission = {
-        'timestamp': datetime.utcnow().isoformat(),
-        'tg_id': callback.from_user.id,
-        'username': callback.from_user.username or '',
-        'full_name': data.get('full_name', ''),
-        'phone': data.get('phone', ''),
-        'has_ozon_card': 'no',
-        'card_applied': datetime.utcnow().isoformat(),
-        'ref_link_used': REF_LINK
-    }
-    save_submission(submission)
-    await notify_admin(f"Новая заявка (оформил карту): {submission}")
-    await callback.message.answer(APPLICATION_SUBMITTED, parse_mode='Markdown', reply_markup=manager_keyboard())
-    await state.finish()
-
+        _save_session(user_id, name, phone, STEP_CARD)
+        await asyncio.gather(
+            callback.answer(),
+            callback.message.answer(PROMO[0], entities=PROMO[1], reply_markup=OZON_REF_KB_JSON),
+        )
+
+@dp.callback_query_handler(lambda c: c.data == 'card_done' and _step(c.from_user.id) == STEP_CARD)
+async def card_done(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    name, phone, _ = _drop_session(user_id)
+    ts = _now_iso()
+    row = (ts, user_id, callback.from_user.username or '', name, phone, 'no', ts, REF_LINK)
+    await save_submission(row)
+    await asyncio.gather(
+        callback.answer('Отлично — пометили, что вы оформили карту.'),
+        notify_admin("Новая заявка (оформил карту): %s", row),
+        callback.message.answer(SUBMITTED[0], entities=SUBMITTED[1], reply_markup=MANAGER_KB_JSON),
+    )
+
+# Весь остальной текст: шаг заявки берём из SESSIONS, без вызова отдельных хэндлеров.
 @dp.message_handler(content_types=types.ContentTypes.TEXT)
-async def fallback(message: types.Message):
-    await message.answer('Чтобы подать заявку, нажмите кнопку *Подать заявку*.', parse_mode='Markdown', reply_markup=main_keyboard())
+async def process_text(message: types.Message):
+    user_id = message.from_user.id
+    session = SESSIONS.get(user_id)
+    if session is None:
+        await message.answer(FALLBACK[0], entities=FALLBACK[1], reply_markup=MAIN_KB_JSON)
+        return
+    _touch_session(user_id)
+    name, phone, step = session
+    text = message.text
+    if step == STEP_NAME:
+        _save_session(user_id, text.strip(), phone, STEP_PHONE)
+        await message.answer(ASK_PHONE, reply_markup=CONTACT_KB_JSON)
+    elif step == STEP_PHONE:
+        phone = text.strip().translate(_PHONE_SEPARATORS)
+        if PHONE_RE.fullmatch(phone):
+            _save_session(user_id, name, phone, STEP_OZON)
+            await message.answer(ASK_OZON, reply_markup=OZON_CHOICE_KB_JSON)
+        else:
+            # И «Ввести номер вручную», и нераспознанный номер получают подсказку формата.
+            await message.answer(ASK_PHONE_MANUAL)
+
+# Кнопки из сессии, которая уже истекла или завершена: снимаем «часики» и просим начать заново.
+@dp.callback_query_handler()
+async def stale_callback(callback: types.CallbackQuery):
+    await asyncio.gather(
+        callback.answer(),
+        callback.message.answer(EXPIRED[0], entities=EXPIRED[1], reply_markup=MAIN_KB_JSON),
+    )
 
 # --- Запуск ---
+def _raise_system_exit():
+    raise SystemExit
+
+async def on_startup(dp: Dispatcher):
+    global submission_queue, writer_task, sweeper_task
+    submission_queue = asyncio.Queue()
+    writer_task = asyncio.create_task(_submission_writer())
+    sweeper_task = asyncio.create_task(_session_sweeper())
+    # executor вызывает on_shutdown только на KeyboardInterrupt/SystemExit, а Railway
+    # останавливает контейнер через SIGTERM — переводим его в SystemExit, чтобы очередь дописалась.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _raise_system_exit)
+
+async def on_shutdown(dp: Dispatcher):
+    sweeper_task.cancel()
+    submission_queue.put_nowait(None)
+    await writer_task
+    _writer_executor.shutdown(wait=True)
+
 if __name__ == '__main__':
     print('Bot is starting...')
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)